@@ -1,16 +1,22 @@
+import os
 from functools import partial
 import gradio as gr
 
 from src.gradio_utils import (
+    categorize_table,
+    change_page,
+    chat_with_session,
+    download_table,
     extract_table_from_chat,
     upload_file,
     redo,
+    search_references,
     undo,
     edit_or_save_changes,
     update_llm_selection,
+    usage_summary,
 )
-from src.llm_calls import query_llm
-from src.data_handler import generate_excel_base64
+from src.state_store import new_session_id, session_store
 
 SYSTEM_PROMPT = """You are a pharmacology assistant specialized in analyzing and structuring medical data.
 
@@ -60,10 +66,8 @@ Always structure your response clearly:
 
 
 with gr.Blocks(theme=gr.themes.Glass()) as app:
-    df_before = gr.State([])  # Undo history
-    df_state = gr.State(None)  # Current DataFrame
-    df_after = gr.State([])  # Redo history
-    last_response = gr.State("")  # Store last LLM response
+    # Tables and history live in the session store, only the key is kept per tab
+    session_id = gr.State(new_session_id, delete_callback=session_store.drop)
     edit_mode = gr.State("Edit")  # Track edit mode
     base64data = gr.State(None)
 
@@ -89,7 +93,7 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
         download_button = gr.DownloadButton(label="Download dataset")
 
         download_button.click(
-            generate_excel_base64, inputs=[df_state], outputs=[excel_data]
+            download_table, inputs=[session_id], outputs=[excel_data]
         )
 
         excel_data.change(
@@ -117,6 +121,8 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
         )
 
         llm_type.change(update_llm_selection, inputs=[llm_type], outputs=[api_key])
+        gr.Markdown("### Usage")
+        usage_display = gr.Markdown()
         with gr.Accordion("System Prompt", open=False):
             system_prompt_box = gr.Textbox(
                 value=SYSTEM_PROMPT, interactive=True, lines=10, label="System Prompt"
@@ -125,12 +131,18 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
     gr.Markdown("## Medications Data CoPilot")
     # Chat Interface
     chat = gr.ChatInterface(
-        fn=query_llm,
+        fn=chat_with_session,
         type="messages",
         description="Chat with an LLM to create a data representation of medications.",
         stop_btn=False,
         save_history=False,
-        additional_inputs=[df_state, llm_type, api_key, system_prompt_box],
+        # Chats must run concurrently for identical requests to share one upstream stream
+        concurrency_limit=(
+            int(os.environ["CHAT_CONCURRENCY_LIMIT"])
+            if os.environ.get("CHAT_CONCURRENCY_LIMIT")
+            else None
+        ),
+        additional_inputs=[session_id, llm_type, api_key, system_prompt_box],
         examples=[
             [
                 "List 10 medications that are known to be effective for Retinitis Pigmentosa"
@@ -145,28 +157,61 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
             ],
         ],
     )
+    # Refresh usage once per chat turn: chatbot_state is only synced after the stream
+    # ends, unlike the chatbot which changes with every streamed chunk
+    chat.chatbot_state.change(
+        usage_summary,
+        inputs=[session_id],
+        outputs=[usage_display],
+        show_progress="hidden",
+    )
     with gr.Row():
         gr.Markdown("### Medications Table")
     with gr.Row():
         update_button = gr.Button(
             "Update table using the chat information", scale=8, interactive=True
         )
+        categorize_button = gr.Button(
+            "Categorize columns", scale=2, interactive=True
+        )
     with gr.Row():
         dataframe_display = gr.DataFrame(interactive=False)
+    with gr.Row():
+        page_number = gr.Number(
+            value=1, precision=0, minimum=1, label="Page (of 1)", interactive=True
+        )
     with gr.Row():
         prev_button = gr.Button("<-", interactive=False, scale=1)
         edit_save_button = gr.Button("Edit", interactive=True, scale=2)
         next_button = gr.Button("->", interactive=False, scale=1)
 
+    with gr.Accordion("References", open=False):
+        reference_query = gr.Textbox(
+            label="Search references", placeholder="URL, DOI, medication or column"
+        )
+        references_display = gr.DataFrame(interactive=False)
+
+    # Reference search, also refreshed after every chat turn
+    reference_query.change(
+        search_references,
+        inputs=[session_id, reference_query],
+        outputs=[references_display],
+        show_progress="hidden",
+    )
+    chat.chatbot_state.change(
+        search_references,
+        inputs=[session_id, reference_query],
+        outputs=[references_display],
+        show_progress="hidden",
+    )
+
     # Save user changes
     edit_save_button.click(
         edit_or_save_changes,
-        inputs=[dataframe_display, df_before, df_state, df_after, edit_mode],
+        inputs=[dataframe_display, session_id, edit_mode],
         outputs=[
             dataframe_display,  # Updated DataFrame
-            df_before,  # Undo history
-            df_state,  # Current state
-            df_after,  # Redo history
+            page_number,  # Update page selector
             prev_button,  # Update prev button
             next_button,  # Update next button
             dataframe_display,  # Update DataFrame interactivity
@@ -174,15 +219,19 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
             edit_mode,  # Update edit mode
         ],
     )
+    # Table paging
+    page_number.input(
+        change_page,
+        inputs=[session_id, page_number],
+        outputs=[dataframe_display, page_number],
+    )
     # Undo button
     prev_button.click(
         undo,
-        inputs=[df_before, df_state, df_after],
+        inputs=[session_id],
         outputs=[
             dataframe_display,
-            df_before,
-            df_state,
-            df_after,
+            page_number,
             prev_button,
             next_button,
         ],
@@ -190,12 +239,10 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
     # Redo button
     next_button.click(
         redo,
-        inputs=[df_before, df_state, df_after],
+        inputs=[session_id],
         outputs=[
             dataframe_display,
-            df_before,
-            df_state,
-            df_after,
+            page_number,
             prev_button,
             next_button,
         ],
@@ -203,12 +250,10 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
     # File upload event
     file_upload.change(
         upload_file,
-        inputs=[file_upload, df_before, df_state, df_after],
+        inputs=[file_upload, session_id],
         outputs=[
             dataframe_display,
-            df_before,
-            df_state,
-            df_after,
+            page_number,
             prev_button,
             next_button,
         ],
@@ -216,12 +261,25 @@ with gr.Blocks(theme=gr.themes.Glass()) as app:
     # Update button copies chat history to text box
     update_button.click(
         partial(extract_table_from_chat, key="Medications"),
-        inputs=[chat.chatbot, df_before, df_state, df_after, llm_type, api_key],
+        inputs=[chat.chatbot, session_id, llm_type, api_key],
+        outputs=[
+            dataframe_display,
+            page_number,
+            prev_button,
+            next_button,
+        ],
+    ).then(  # Refresh the cells linked to each reference
+        search_references,
+        inputs=[session_id, reference_query],
+        outputs=[references_display],
+    )
+    # Categorize button maps each column's distinct values to categories
+    categorize_button.click(
+        categorize_table,
+        inputs=[session_id, llm_type, api_key],
         outputs=[
             dataframe_display,
-            df_before,
-            df_state,
-            df_after,
+            page_number,
             prev_button,
             next_button,
         ],
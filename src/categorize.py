@@ -0,0 +1,113 @@
+import json
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from src.data_handler import get_name_column
+from src.llm_calls import query_llm
+from src.parse_response import json_to_dict
+from src.usage import BUDGET_REACHED_MESSAGE, BudgetExceededError, estimate_tokens
+
+CATEGORIZE_SYSTEM_PROMPT = """
+You are a pharmacology assistant specialized in analyzing and structuring medical data.
+You will be given a JSON object with the distinct values of each column of a medications dataset.
+For each column, group its values into up to {max_categories} short, meaningful categories
+for simple classification.
+
+Return a JSON object mapping every value to its category, with the following format:
+```json
+{{
+    "column1": {{"value1": "category", "value2": "category", ..}},
+    "column2": {{"value1": "category", "value2": "category", ..}}
+}}
+```
+
+Guidelines:
+- Map every value you were given, using the value exactly as given as the key
+- Use the same category names for values that mean the same thing
+- Make sure the response contains only a valid JSON
+- Avoid adding text before or after
+"""
+
+
+def distinct_values(df: pd.DataFrame, max_categories: int = 5) -> Dict[str, List[str]]:
+    """Distinct values of each column that has more than `max_categories` of them.
+    The medication name column is never categorized."""
+    name_column = get_name_column(df)
+    values = {}
+    for column in df.columns:
+        if column == name_column:
+            continue
+        unique = df[column].dropna().astype(str).unique().tolist()
+        if len(unique) > max_categories:
+            values[str(column)] = unique
+    return values
+
+
+def apply_categories(df: pd.DataFrame, mappings: Dict[str, Dict[str, str]]) -> pd.DataFrame:
+    """Replace values with their categories, keeping values missing from the mapping.
+    Columns without a value to category dict are left unchanged."""
+    df = df.copy()
+    for column in df.columns:
+        mapping = mappings.get(str(column))
+        if not mapping or not isinstance(mapping, dict):
+            continue
+        categories = df[column].astype(str).map(mapping)
+        df[column] = categories.where(categories.notna(), df[column])
+    return df
+
+
+def categorize_columns(
+    df: pd.DataFrame,
+    llm_type: str,
+    api_key: str,
+    max_categories: int = 5,
+    session_id: Optional[str] = None,
+) -> pd.DataFrame:
+    """Categorize each column of the dataset into up to `max_categories` categories.
+
+    Only the distinct values of each column are sent to the LLM, and the returned
+    value to category mapping is applied to the whole table, so the cost depends on
+    the number of distinct values rather than on the table size.
+
+    Args:
+        df (pd.DataFrame): The dataset to categorize.
+        llm_type (str): Perplexity or OpenAI.
+        api_key (str): The API key for the selected LLM.
+        max_categories (int): Max number of categories per column.
+        session_id (str): Session to account the usage for.
+    Returns:
+        pd.DataFrame: A new dataset with categorized values.
+    Raises:
+        ValueError: If the LLM response is not a valid mapping.
+        BudgetExceededError: If the request does not fit in the usage budget.
+    """
+    values = distinct_values(df, max_categories=max_categories)
+    if not values:
+        return df.copy()
+
+    values_json = json.dumps(values, ensure_ascii=False)
+    response = ""
+    for response in query_llm(
+        messages=values_json,
+        history=None,
+        df=None,
+        llm_type=llm_type,
+        api_key=api_key,
+        system_prompt=CATEGORIZE_SYSTEM_PROMPT.format(max_categories=max_categories),
+        session_id=session_id,
+        # The mapping repeats every value next to its category
+        expected_completion_tokens=2 * estimate_tokens(values_json),
+    ):
+        pass  # Responses are cumulative, only the last one is needed
+
+    if response == BUDGET_REACHED_MESSAGE:
+        raise BudgetExceededError(response)
+
+    mappings = json_to_dict(response)
+    if not isinstance(mappings, dict) or not any(
+        isinstance(mapping, dict) for mapping in mappings.values()
+    ):
+        raise ValueError("The categories returned by the LLM are not a JSON object.")
+
+    return apply_categories(df, mappings)
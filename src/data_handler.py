@@ -1,18 +1,30 @@
 import tempfile
 import io
-from typing import List
+from typing import List, Optional
 
 import pandas as pd
 import base64
 
 
-def generate_excel_base64(dataframe: pd.DataFrame) -> str:
-    """Generates an Excel file from the provided data frame and returns it as a base64 string."""
+def get_name_column(dataframe: pd.DataFrame):
+    """The column identifying medications: the first one containing "name", or the first column."""
+    return next(
+        (c for c in dataframe.columns if "name" in str(c).lower()), dataframe.columns[0]
+    )
+
+
+def generate_excel_base64(
+    dataframe: pd.DataFrame, references: Optional[pd.DataFrame] = None
+) -> str:
+    """Generates an Excel file from the provided data frame and returns it as a base64 string.
+    References, if provided, are written to a separate "References" sheet."""
     output_stream = io.BytesIO()  # Create in-memory buffer
 
     # Ensure `xlsxwriter` writes to the buffer
     with pd.ExcelWriter(output_stream, engine="xlsxwriter") as writer:
         dataframe.to_excel(writer, index=False, sheet_name="Data")
+        if references is not None and not references.empty:
+            references.to_excel(writer, index=False, sheet_name="References")
 
     output_stream.seek(0)  # Move to the beginning for reading
     base64_data = base64.b64encode(output_stream.getvalue()).decode(
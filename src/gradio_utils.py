@@ -1,59 +1,144 @@
 import pandas as pd
 
-from src.llm_calls import llm_extract_table
+from src.categorize import categorize_columns
+from src.data_handler import generate_excel_base64
+from src.llm_calls import llm_extract_table, query_llm
 from src.parse_response import extract_and_return_data_table
+from src.state_store import SessionState, session_store
+from src.table_view import mark_rendered, merge_page, render_table
+from src.usage import BudgetExceededError, usage_ledger
 import gradio as gr
 
 
-def __update_df_state(df_before, df_state, updated_df):
+def __update_df_state(state: SessionState, updated_df):
     new_df = pd.DataFrame(updated_df)
 
-    if df_before is not None:
-        new_df_before = df_before + [df_state]
-    else:
-        new_df_before = [df_state]
-
-    new_df_after = []  # Clear redo history
-    new_df_state = new_df.copy()
+    state.df_before = state.df_before + [state.df_state]
+    state.df_after = []  # Clear redo history
+    state.df_state = new_df.copy()
+
+    return state
+
+
+def chat_with_session(message, history, session_id, llm_type, api_key, system_prompt):
+    """Stream an LLM response using the session's current DataFrame."""
+    with session_store.session(session_id) as state:
+        citations = []
+        response = ""
+        for response in query_llm(
+            message,
+            history,
+            state.df_state,
+            llm_type,
+            api_key,
+            system_prompt,
+            session_id=session_id,
+            history_summary=state.history_summary,
+            citations_callback=citations.extend,
+        ):
+            yield response
+
+        state.last_response = response
+        state.last_citations = citations
+        state.references.add_response(response, citations)
+
+
+def extract_table_from_chat(chat_output, session_id, llm_type, api_key, key="Medications"):
+    with session_store.session(session_id) as state:
+        try:
+            updated_df = extract_and_return_data_table(chat_output=chat_output, key=key)
+        except ValueError:
+            try:
+                json_str = llm_extract_table(
+                    chat_output, llm_type, api_key, session_id=session_id
+                )
+                updated_df = extract_and_return_data_table(chat_output=json_str, key=key)
+            except KeyError:
+                gr.Error(
+                    "Cannot extract table information from chat. "
+                    "Please ask the LLM to provide the dataset in JSON format.",
+                    duration=None,
+                )
+                updated_df = state.df_before
+            except ValueError:
+                gr.Error(
+                    "Cannot extract table information from chat. "
+                    "Please ask the LLM to provide the dataset in JSON format.",
+                    duration=None,
+                )
+                updated_df = state.df_before
+
+        old_df = state.df_state
+        __update_df_state(state, updated_df)
+        state.references.link_table(
+            state.last_response, state.last_citations, old_df, state.df_state
+        )
+        display_update, page_update = render_table(state)
+        return (
+            display_update,
+            page_update,
+            gr.update(interactive=True),
+            gr.update(interactive=False),
+        )
 
-    return new_df_before, new_df_state, new_df_after
 
+def categorize_table(session_id, llm_type, api_key):
+    """Categorize the columns of the current table, sending only their distinct values to the LLM."""
+    with session_store.session(session_id) as state:
+        if state.df_state is None:
+            raise gr.Error("There is no table to categorize yet.")
 
-def extract_table_from_chat(
-    chat_output, df_before, df_state, df_after, llm_type, api_key, key="Medications"
-):
-    try:
-        updated_df = extract_and_return_data_table(chat_output=chat_output, key=key)
-    except ValueError:
         try:
-            json_str = llm_extract_table(chat_output, llm_type, api_key)
-            updated_df = extract_and_return_data_table(chat_output=json_str, key=key)
-        except KeyError:
-            gr.Error(
-                "Cannot extract table information from chat. "
-                "Please ask the LLM to provide the dataset in JSON format.",
-                duration=None,
+            categorized_df = categorize_columns(
+                state.df_state, llm_type, api_key, session_id=session_id
             )
-            updated_df = df_before
+        except BudgetExceededError as e:
+            raise gr.Error(str(e))
         except ValueError:
-            gr.Error(
-                "Cannot extract table information from chat. "
-                "Please ask the LLM to provide the dataset in JSON format.",
-                duration=None,
+            raise gr.Error(
+                "Cannot parse the categories returned by the LLM. Please try again."
             )
-            updated_df = df_before
 
-    new_df_before, new_df_state, new_df_after = __update_df_state(
-        df_before, df_state, updated_df
-    )
-    return (
-        new_df_state,
-        new_df_before,
-        new_df_state,
-        new_df_after,
-        gr.update(interactive=True),
-        gr.update(interactive=False),
+        __update_df_state(state, categorized_df)
+        display_update, page_update = render_table(state)
+        return (
+            display_update,
+            page_update,
+            gr.update(interactive=True),
+            gr.update(interactive=False),
+        )
+
+
+def download_table(session_id):
+    """Return the session's current DataFrame and references as a base64 encoded Excel file."""
+    with session_store.session(session_id) as state:
+        return generate_excel_base64(state.df_state, references=state.references.to_dataframe())
+
+
+def search_references(session_id, query):
+    """References of the session matching the query (URL, DOI, medication or column)."""
+    with session_store.session(session_id) as state:
+        return state.references.search(query)
+
+
+def usage_summary(session_id):
+    """Markdown summary of the session's token usage and cost."""
+    usage = usage_ledger.session_usage(session_id)
+    summary = (
+        f"Requests: {usage['requests']}  \n"
+        f"Tokens: {usage['prompt_tokens']} prompt, {usage['completion_tokens']} completion  \n"
+        f"Cost: ${usage['cost']:.4f}"
     )
+    if usage_ledger.session_budget is not None:
+        summary += f" of ${usage_ledger.session_budget:.2f}"
+    return summary
+
+
+def change_page(session_id, page):
+    """Show another page of the table (`page` is one based, as shown in the UI)."""
+    with session_store.session(session_id) as state:
+        display_update, page_update = render_table(state, page=int(page or 1) - 1)
+        return display_update, page_update
 
 
 def update_llm_selection(selected_llm):
@@ -67,99 +152,98 @@ def update_llm_selection(selected_llm):
         raise ValueError("Invalid LLM type selected.")
 
 
-def edit_or_save_changes(updated_df, df_before, df_state, df_after, current_edit_mode):
+def edit_or_save_changes(updated_df, session_id, current_edit_mode):
     """Save user changes, update undo history."""
+    with session_store.session(session_id) as state:
+        # The display only holds the current page
+        new_df = merge_page(state.df_state, updated_df, state.page)
+        state.df_before = state.df_before + [state.df_state.copy()]
+        state.df_after = []  # Clear redo history
+        state.df_state = new_df.copy()
+
+        if current_edit_mode == "Save":
+            # The browser already shows the user's edits
+            mark_rendered(state, updated_df)
+            display_update, page_update = render_table(state)
+
+            # User wants to move from save to edit
+            return (
+                display_update,
+                gr.update(**page_update, interactive=True),  # page can change again
+                gr.update(
+                    interactive=True
+                ),  # prev button is now enabled as there was a change
+                gr.update(interactive=False),  # next button
+                gr.update(interactive=True),  # df display
+                gr.update(value="Edit"),  # edit button
+                "Edit",
+            )
+        elif current_edit_mode == "Edit":
+            display_update, page_update = render_table(state)
+
+            return (
+                display_update,
+                gr.update(**page_update, interactive=False),  # no paging while editing
+                gr.update(interactive=False),  # prev button
+                gr.update(interactive=False),  # next button
+                gr.update(interactive=True),  # df display
+                gr.update(value="Save"),  # edit button
+                "Save",
+            )
 
-    new_df = pd.DataFrame(updated_df)
-    new_df_before = df_before + [df_state.copy()]
-    new_df_after = []  # Clear redo history
-    new_df_state = new_df.copy()
+        else:
+            raise ValueError(f"Wrong edit mode selected: {current_edit_mode}. ")
 
-    if current_edit_mode == "Save":
-        # User wants to move from save to edit
-        return (
-            new_df,
-            new_df_before,
-            new_df_state,
-            new_df_after,
-            gr.update(
-                interactive=True
-            ),  # prev button is now enabled as there was a change
-            gr.update(interactive=False),  # next button
-            gr.update(interactive=True),  # df display
-            gr.update(value="Edit"),  # edit button
-            "Edit",
-        )
-    elif current_edit_mode == "Edit":
-        return (
-            new_df_state,
-            new_df_before,
-            new_df_state,
-            new_df_after,
-            gr.update(interactive=False),  # prev button
-            gr.update(interactive=False),  # next button
-            gr.update(interactive=True),  # df display
-            gr.update(value="Save"),  # edit button
-            "Save",
-        )
 
-    else:
-        raise ValueError(f"Wrong edit mode selected: {current_edit_mode}. ")
+def undo(session_id):
+    """Undo user change without enabling Save button."""
+    with session_store.session(session_id) as state:
+        if not state.df_before:
+            return (
+                gr.update(),
+                gr.update(),
+                gr.update(interactive=False),
+                gr.update(interactive=(len(state.df_after) > 0)),
+            )
 
+        state.df_after = state.df_after + [state.df_state.copy()]
+        state.df_state = state.df_before[-1]
+        state.df_before = state.df_before[:-1]
+        display_update, page_update = render_table(state)
 
-def undo(df_before, df_state, df_after):
-    """Undo user change without enabling Save button."""
-    if not df_before:
         return (
-            df_state,
-            df_before,
-            df_state,
-            df_after,
-            gr.update(interactive=False),
-            gr.update(interactive=(len(df_after) > 0)),
+            display_update,
+            page_update,
+            gr.update(interactive=(len(state.df_before) > 0)),  # prev button
+            gr.update(interactive=(len(state.df_after) > 0)),  # next button
         )
 
-    new_df_after = df_after + [df_state.copy()]
-    new_df_state = df_before[-1]
-    new_df_before = df_before[:-1]
-
-    return (
-        new_df_state,
-        new_df_before,
-        new_df_state,
-        new_df_after,
-        gr.update(interactive=(len(new_df_before) > 0)),  # prev button
-        gr.update(interactive=(len(new_df_after) > 0)),  # next button
-    )
-
 
-def redo(df_before, df_state, df_after):
+def redo(session_id):
     """Redo user change without enabling Save button."""
-    if not df_after:
-        return (
-            df_state,
-            df_before,
-            df_state,
-            df_after,
-            gr.update(interactive=(len(df_before) > 0)),
-            gr.update(interactive=False),
-        )
+    with session_store.session(session_id) as state:
+        if not state.df_after:
+            return (
+                gr.update(),
+                gr.update(),
+                gr.update(interactive=(len(state.df_before) > 0)),
+                gr.update(interactive=False),
+            )
 
-    if df_state is None:
-        df_state = df_after
+        if state.df_state is None:
+            state.df_state = state.df_after
 
-    new_df_before = df_before + [df_state.copy()]
-    new_df_state = df_after[-1]
-    new_df_after = df_after[:-1]
+        state.df_before = state.df_before + [state.df_state.copy()]
+        state.df_state = state.df_after[-1]
+        state.df_after = state.df_after[:-1]
+        display_update, page_update = render_table(state)
 
-    return (
-        new_df_state,
-        new_df_before,
-        new_df_state,
-        new_df_after,
-        gr.update(interactive=(len(new_df_before) > 0)),
-        gr.update(interactive=(len(new_df_after) > 0)),
-    )
+        return (
+            display_update,
+            page_update,
+            gr.update(interactive=(len(state.df_before) > 0)),
+            gr.update(interactive=(len(state.df_after) > 0)),
+        )
 
 
 # def toggle_save_edit(button_state, dataframe_display):
@@ -170,22 +254,20 @@ def redo(df_before, df_state, df_after):
 #
 
 
-def upload_file(file, df_before, df_state, df_after):
+def upload_file(file, session_id):
     if file is None:
         return gr.update()
 
     df = pd.read_excel(file.name, engine="openpyxl")
 
-    new_df_before, new_df_state, new_df_after = __update_df_state(
-        df_before, df_state, df
-    )
+    with session_store.session(session_id) as state:
+        __update_df_state(state, df)
+        display_update, page_update = render_table(state, page=0)
 
-    # print("Uploaded DataFrame:\n", df)  # Print DataFrame to console
-    return (
-        df,
-        new_df_before,
-        df,
-        new_df_after,
-        gr.update(interactive=False),
-        gr.update(interactive=False),
-    )
+        # print("Uploaded DataFrame:\n", df)  # Print DataFrame to console
+        return (
+            display_update,
+            page_update,
+            gr.update(interactive=False),
+            gr.update(interactive=False),
+        )
@@ -0,0 +1,143 @@
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from src.parse_response import json_to_pandas
+
+DATASET_PLACEHOLDER = "[dataset omitted, the current dataset is sent separately]"
+
+# Number of most recent messages that are kept in full (without datasets)
+KEEP_RECENT_MESSAGES = 4
+# Max number of summary lines for older messages
+MAX_SUMMARY_LINES = 20
+MAX_SUMMARY_LINE_LENGTH = 200
+
+_FENCED_JSON = re.compile(r"```(?:json)?\s*[\[{].*?```", re.DOTALL)
+_BARE_DATASET = re.compile(r"\{\s*\"Medications\"\s*:\s*\[.*\]\s*}", re.DOTALL)
+_MARKDOWN_TABLE = re.compile(r"(?:^\s*\|.*\|\s*$\n?){2,}", re.MULTILINE)
+
+
+@dataclass
+class HistorySummary:
+    """Incremental summary of the older messages of a conversation."""
+
+    lines: List[str] = field(default_factory=list)
+    n_summarized: int = 0  # Number of history messages already summarized
+
+
+def strip_datasets(text: str) -> str:
+    """Replace JSON datasets and markdown tables embedded in a message with a placeholder."""
+    text = _FENCED_JSON.sub(DATASET_PLACEHOLDER, text)
+    text = _BARE_DATASET.sub(DATASET_PLACEHOLDER, text)
+    text = _MARKDOWN_TABLE.sub(DATASET_PLACEHOLDER + "\n", text)
+    return text.strip()
+
+
+def _message_text(message: Dict) -> str:
+    content = message.get("content", "")
+    # Files and other components in the chat are not text
+    return content if isinstance(content, str) else ""
+
+
+def _format_message(message: Dict, keep_dataset: bool = False) -> str:
+    text = _message_text(message)
+    if not keep_dataset:
+        text = strip_datasets(text)
+    return f"{message.get('role', 'user').capitalize()}: {text}"
+
+
+def _latest_assistant_index(history: List[Dict]) -> Optional[int]:
+    for index in range(len(history) - 1, -1, -1):
+        if history[index].get("role") == "assistant" and _message_text(history[index]):
+            return index
+    return None
+
+
+def latest_dataset_applied(history: Optional[List[Dict]], df: Optional[pd.DataFrame]) -> bool:
+    """Whether the dataset in the latest assistant message is already the current table.
+
+    The table only changes when the user applies a response to it, so until then the
+    latest response holds the only copy of its dataset.
+    """
+    index = _latest_assistant_index(history or [])
+    if index is None:
+        return True
+
+    text = _message_text(history[index])
+    if strip_datasets(text) == text.strip():
+        return True  # No dataset in the message
+    if df is None:
+        return False
+
+    try:
+        latest_df = json_to_pandas(text, key="Medications")
+    except (ValueError, KeyError, TypeError):
+        return False
+    return latest_df.reset_index(drop=True).equals(df.reset_index(drop=True))
+
+
+def _summarize_message(message: Dict) -> str:
+    """One line summary: the user's request, or the first sentence of an answer."""
+    text = strip_datasets(_message_text(message)).replace(DATASET_PLACEHOLDER, "")
+    text = " ".join(text.split())
+    if message.get("role") == "assistant":
+        text = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    if len(text) > MAX_SUMMARY_LINE_LENGTH:
+        text = text[:MAX_SUMMARY_LINE_LENGTH].rstrip() + "..."
+    return f"- {message.get('role', 'user').capitalize()}: {text}"
+
+
+def compact_history(
+    history: Optional[List[Dict]],
+    summary: Optional[HistorySummary] = None,
+    keep_latest_dataset: bool = False,
+) -> str:
+    """Turn the chat history into a compact text for the LLM.
+
+    Recent messages are kept without their embedded datasets, older ones are
+    summarized to one line each. The summary is updated incrementally, so only
+    messages that were not summarized before are processed.
+
+    Args:
+        history (list): Conversation history, in the gradio messages format.
+        summary (HistorySummary): Cached summary for this conversation, updated in place.
+        keep_latest_dataset (bool): Keep the dataset of the latest assistant message,
+            e.g. when it was not applied to the current table yet.
+    Returns:
+        str: The compacted history.
+    """
+    if not history:
+        return "None"
+    if summary is None:
+        summary = HistorySummary()
+
+    older = history[:-KEEP_RECENT_MESSAGES]
+    recent = history[-KEEP_RECENT_MESSAGES:]
+
+    if summary.n_summarized > len(older):
+        # The chat was cleared, start over
+        summary.lines = []
+        summary.n_summarized = 0
+
+    for message in older[summary.n_summarized :]:
+        if _message_text(message):
+            summary.lines.append(_summarize_message(message))
+    summary.n_summarized = len(older)
+    summary.lines = summary.lines[-MAX_SUMMARY_LINES:]
+
+    parts = []
+    if summary.lines:
+        parts.append("Summary of earlier messages:\n" + "\n".join(summary.lines))
+    latest = _latest_assistant_index(history) if keep_latest_dataset else None
+    offset = len(history) - len(recent)
+    parts.append(
+        "Recent messages:\n"
+        + "\n\n".join(
+            _format_message(message, keep_dataset=(offset + i == latest))
+            for i, message in enumerate(recent)
+            if _message_text(message)
+        )
+    )
+    return "\n\n".join(parts)
@@ -1,15 +1,66 @@
 import json
 import os
-from typing import Generator, List, Optional
+from typing import Callable, Dict, Generator, List, Optional
 
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from src.history import HistorySummary, compact_history, latest_dataset_applied
+from src.single_flight import Flight, single_flight
+from src.usage import (
+    BUDGET_REACHED_MESSAGE,
+    CHEAPER_MODELS,
+    DEFAULT_MODELS,
+    estimate_messages_tokens,
+    estimate_tokens,
+    hash_api_key,
+    request_key,
+    response_cache,
+    usage_ledger,
+)
+
 load_dotenv()
 
 
+def _build_messages(
+    messages: List, history: str, df: Optional[pd.DataFrame], system_prompt: str, compact=False
+) -> List:
+    """Prepend the system prompt, history and dataset to the user message(s).
+    The compact encoding sends the dataset as CSV instead of JSON."""
+    if df is None:
+        dataset = {}
+    elif compact:
+        dataset = df.to_csv(index=False)
+    else:
+        dataset = df.to_json()
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"Past interactions: {history}"},
+        {
+            "role": "assistant",
+            "content": f"Dataset{' (CSV)' if compact else ''}: {dataset}",
+        },
+    ] + messages
+
+
+def _expected_completion_tokens(df: Optional[pd.DataFrame]) -> int:
+    # Responses include the full dataset plus some text
+    dataset_tokens = estimate_tokens(df.to_json()) if df is not None else 0
+    return dataset_tokens + 500
+
+
+def _estimated_usage(full_messages: List, response: str) -> Dict:
+    """Usage estimate for a stream that was interrupted before the provider reported it."""
+    return {
+        "prompt_tokens": estimate_messages_tokens(full_messages),
+        "completion_tokens": estimate_tokens(response),
+        "estimated": True,
+    }
+
+
 def query_llm(
     messages,
     history: List,
@@ -17,15 +68,29 @@ def query_llm(
     llm_type: str,
     api_key: str,
     system_prompt: str,
+    session_id: Optional[str] = None,
+    history_summary: Optional[HistorySummary] = None,
+    citations_callback: Optional[Callable[[List[str]], None]] = None,
+    expected_completion_tokens: Optional[int] = None,
 ) -> Generator[str, None, None]:
     """Chat function that streams responses using an LLM API.
 
+    Token usage is recorded in the usage ledger. If a turn would go over the session
+    or API key budget, a cached response, a compact dataset encoding or a cheaper model
+    are used instead (in that order). Identical requests in flight at the same time share
+    a single upstream stream.
+
     Args:
         messages (str or list): User input message(s).
         history (list): Conversation history.
         df (pd.DataFrame): a representation of the data already obtained
         system_prompt (str): The syste prompt
         api_key (str): The OpenAI api key
+        session_id (str): Session to account the usage for
+        history_summary (HistorySummary): Cached summary of older messages, updated in place
+        citations_callback (Callable): Called with the citations returned by the provider
+        expected_completion_tokens (int): Expected response size, used for the budget check.
+            By default, the dataset plus some text.
     Returns:
         str: The assistant's response.
     """
@@ -40,28 +105,91 @@ def query_llm(
 
     print(f"LLM Type: {llm_type}, API Key len: {len(api_key)}")  # Debugging
 
+    if llm_type not in DEFAULT_MODELS:
+        yield "Unsupported LLM type. Please choose either 'OpenAI' or 'Perplexity'."
+        return
+
     if isinstance(messages, str):
         messages = [{"role": "user", "content": messages}]
 
-    # Extract last 2 messages from history (if available)
-    history = history[-2:] if history else []
+    # Drop embedded datasets and summarize older messages. The latest dataset is kept
+    # until it is applied to the table, as it is not part of the dataset sent below
+    history = compact_history(
+        history,
+        history_summary,
+        keep_latest_dataset=not latest_dataset_applied(history, df),
+    )
 
     # Build message history (prepend system prompt)
-    full_messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"Past interactions: {history}"},
-        {
-            "role": "assistant",
-            "content": f"Dataset: {df.to_json() if df is not None else {}}",
-        },
-    ] + messages
+    model = DEFAULT_MODELS[llm_type]
+    full_messages = _build_messages(messages, history, df, system_prompt)
+    key = request_key(full_messages, llm_type, model)
+    completion_tokens = expected_completion_tokens or _expected_completion_tokens(df)
 
-    if llm_type == "Perplexity":
-        yield from query_perplexity(full_messages, api_key=api_key)
-    elif llm_type == "OpenAI":
-        yield from query_openai(full_messages, api_key=api_key)
-    else:
-        yield "Unsupported LLM type. Please choose either 'OpenAI' or 'Perplexity'."
+    def affordable():
+        prompt_tokens = estimate_messages_tokens(full_messages)
+        return usage_ledger.can_afford(
+            session_id, api_key, model, prompt_tokens, completion_tokens
+        )
+
+    note = ""
+    if not affordable():
+        cached = response_cache.get(key)
+        if cached is not None:
+            yield f"_(Usage budget reached, showing a cached response)_\n\n{cached}"
+            return
+
+        full_messages = _build_messages(messages, history, df, system_prompt, compact=True)
+        note = "_(Usage budget almost reached, using a compact dataset encoding)_\n\n"
+        if not affordable():
+            model = CHEAPER_MODELS.get(model, model)
+            note = f"_(Usage budget almost reached, using {model} with a compact dataset encoding)_\n\n"
+        if not affordable():
+            yield BUDGET_REACHED_MESSAGE
+            return
+
+    # The original request is cached, but the degraded one is what gets sent
+    flight_key = key if not note else request_key(full_messages, llm_type, model)
+
+    def upstream(flight: Flight) -> Generator[str, None, None]:
+        response = ""
+        try:
+            if llm_type == "Perplexity":
+                stream = query_perplexity(
+                    full_messages,
+                    api_key=api_key,
+                    model=model,
+                    usage_callback=flight.usage.update,
+                    citations_callback=flight.citations.extend,
+                )
+            else:
+                stream = query_openai(
+                    full_messages,
+                    api_key=api_key,
+                    model=model,
+                    usage_callback=flight.usage.update,
+                )
+            for response in stream:
+                yield response
+        finally:
+            # Providers only report usage for requests that were actually streamed
+            if flight.usage:
+                usage_ledger.record(session_id, api_key, model, flight.usage)
+                if not flight.usage.get("estimated"):
+                    response_cache.put(key, response)
+
+    # Identical requests with the same API key already in flight (e.g. the same example
+    # prompt on a shared dataset) share one upstream stream
+    flight, started = single_flight.join(f"{hash_api_key(api_key)}:{flight_key}", upstream)
+    for response in flight.subscribe():
+        yield note + response
+
+    if not started and flight.usage:
+        # The API key was charged once, by the request that started the flight
+        usage_ledger.record(session_id, api_key, model, flight.usage, shared=True)
+
+    if flight.citations and citations_callback:
+        citations_callback(list(flight.citations))
 
 
 def query_perplexity(
@@ -69,6 +197,8 @@ def query_perplexity(
     api_key: str,
     url="https://api.perplexity.ai/chat/completions",
     model="sonar-pro",
+    usage_callback: Optional[Callable[[Dict], None]] = None,
+    citations_callback: Optional[Callable[[List[str]], None]] = None,
 ):
     """Query Perplexity AI API for a response.
 
@@ -77,6 +207,8 @@ def query_perplexity(
         api_key (str): Perplexity API key.
         url (str): API endpoint URL.
         model (str): Model to use for the query.
+        usage_callback (Callable): Called with the token usage once the stream ends.
+        citations_callback (Callable): Called with the cited URLs once the stream ends.
 
     Returns:
         str: Parsed JSON response from Perplexity AI API.
@@ -93,47 +225,82 @@ def query_perplexity(
         "Content-Type": "application/json",
     }
 
+    usage = None
+    citations = None
+    content = ""
     with requests.post(url, json=payload, headers=headers, stream=True) as response:
         if response.status_code == 200:
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        line = line.decode("utf-8").strip()
-                        if line.startswith("data: "):
-                            line = line[len("data: ") :]  # Remove "data: " prefix
-
-                        data = json.loads(line)
-                        if "choices" in data and len(data["choices"]) > 0:
-                            yield data["choices"][0]["message"]["content"]
-                    except json.JSONDecodeError:
-                        yield f"Error decoding JSON: {line}"
+            try:
+                for line in response.iter_lines():
+                    if line:
+                        try:
+                            line = line.decode("utf-8").strip()
+                            if line.startswith("data: "):
+                                line = line[len("data: ") :]  # Remove "data: " prefix
+
+                            data = json.loads(line)
+                            if data.get("usage"):
+                                usage = data["usage"]
+                            if data.get("citations"):
+                                citations = data["citations"]
+                            if "choices" in data and len(data["choices"]) > 0:
+                                content = data["choices"][0]["message"]["content"]
+                                yield content
+                        except json.JSONDecodeError:
+                            yield f"Error decoding JSON: {line}"
+            finally:
+                # Only a stream that started can be billed, failed requests are not charged
+                if usage is None and content:
+                    usage = _estimated_usage(full_messages, content)
+                if usage and usage_callback:
+                    usage_callback(usage)
+                if citations and citations_callback:
+                    citations_callback(citations)
         else:
             yield f"API request failed with status code {response.status_code}, details: {response.text}"
 
 
-def query_openai(full_messages, api_key: str) -> Generator[str, None, None]:
+def query_openai(
+    full_messages,
+    api_key: str,
+    model="gpt-4-turbo",
+    usage_callback: Optional[Callable[[Dict], None]] = None,
+) -> Generator[str, None, None]:
     """Chat function that streams responses using OpenAI API.
 
     Args:
         full_messages (list): List of messages in the conversation.
         api_key (str): OpenAI API key.
+        model (str): Model to use for the query.
+        usage_callback (Callable): Called with the token usage once the stream ends.
     """
     openai_client = OpenAI(api_key=api_key)
 
     response = openai_client.chat.completions.create(
-        model="gpt-4-turbo",
+        model=model,
         messages=full_messages,
         stream=True,  # Enable streaming
+        stream_options={"include_usage": True},  # Usage is sent in the last chunk
     )
 
+    usage = None
     llm_response = ""
-    for chunk in response:
-        if chunk.choices[0].delta.content:
-            llm_response += chunk.choices[0].delta.content
-            yield llm_response
+    try:
+        for chunk in response:
+            if chunk.usage:
+                usage = chunk.usage.model_dump()
+            if chunk.choices and chunk.choices[0].delta.content:
+                llm_response += chunk.choices[0].delta.content
+                yield llm_response
+    finally:
+        # The stream was interrupted before the usage chunk, account an estimate
+        if usage is None and llm_response:
+            usage = _estimated_usage(full_messages, llm_response)
+        if usage and usage_callback:
+            usage_callback(usage)
 
 
-def llm_extract_table(chat_output, llm_type, api_key) -> str:
+def llm_extract_table(chat_output, llm_type, api_key, session_id=None) -> str:
     system_prompt = """
     You are a pharmacology assistant specialized in analyzing and structuring medical data.
     Your role is to extract information in either markdown, JSON or text, and turn it structured information.
@@ -160,6 +327,7 @@ def llm_extract_table(chat_output, llm_type, api_key) -> str:
         llm_type=llm_type,
         api_key=api_key,
         system_prompt=system_prompt,
+        session_id=session_id,
     )
     json_str = "".join(response).strip()
     return json_str
@@ -20,6 +20,7 @@ def query_llm_mock(
     llm_type: str,
     api_key: str,
     system_prompt: str,
+    session_id: Optional[str] = None,
 ):
     """Chat function that streams responses using mock llm.
 
@@ -75,7 +76,7 @@ def query_llm_mock(
     )
 
 
-def llm_extract_table_mock(chat_output, llm_type, api_key) -> str:
+def llm_extract_table_mock(chat_output, llm_type, api_key, session_id=None) -> str:
     dic = {
         "Medications": [
             {
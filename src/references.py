@@ -0,0 +1,164 @@
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pandas as pd
+
+from src.data_handler import get_name_column
+
+_URL = re.compile(r"https?://[^\s<>\"'\]]+")
+_DOI = re.compile(r"\b(10\.\d{4,9}/[^\s<>\"'\]]+)")
+_CITATION_MARKER = re.compile(r"\[(\d+)]")
+_TRAILING_PUNCTUATION = ".,;:"
+
+
+@dataclass
+class Reference:
+    """A source cited by the LLM, and the table cells it supports."""
+
+    key: str  # Normalized URL or "doi:<doi>"
+    url: str
+    doi: Optional[str] = None
+    cells: Set[Tuple[str, str]] = field(default_factory=set)  # (medication, column)
+    mentions: int = 0  # Number of responses citing this reference
+
+
+def _strip_trailing(url_or_doi: str) -> str:
+    """Strip trailing punctuation, and closing parentheses that are not balanced
+    (e.g. a URL at the end of a parenthesized sentence or a markdown link)."""
+    while True:
+        stripped = url_or_doi.rstrip(_TRAILING_PUNCTUATION)
+        if stripped.endswith(")") and stripped.count(")") > stripped.count("("):
+            stripped = stripped[:-1]
+        if stripped == url_or_doi:
+            return stripped
+        url_or_doi = stripped
+
+
+def normalize_doi(doi: str) -> str:
+    return _strip_trailing(doi).lower()
+
+
+def normalize_url(url: str) -> str:
+    """Normalize a URL so the same source cited differently gets the same key."""
+    url = _strip_trailing(url)
+    parts = urlsplit(url)
+    query = urlencode(
+        [(k, v) for k, v in parse_qsl(parts.query) if not k.startswith("utm_")]
+    )
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[len("www.") :]
+    return urlunsplit(("https", netloc, parts.path.rstrip("/"), query, ""))
+
+
+def reference_key(url_or_doi: str) -> Tuple[str, str, Optional[str]]:
+    """Return the (key, url, doi) of a URL or a DOI. DOIs take precedence over URLs."""
+    doi_match = _DOI.search(url_or_doi)
+    if doi_match:
+        doi = normalize_doi(doi_match.group(1))
+        url = url_or_doi if url_or_doi.startswith("http") else f"https://doi.org/{doi}"
+        return f"doi:{doi}", _strip_trailing(url), doi
+
+    url = _strip_trailing(url_or_doi)
+    return normalize_url(url), url, None
+
+
+def extract_references(text: str, citations: Optional[List[str]] = None) -> List[str]:
+    """All URLs and DOIs in a response, plus the citations returned by the provider."""
+    found = list(citations or [])
+    found += [_strip_trailing(url) for url in _URL.findall(text or "")]
+    dois = [_strip_trailing(doi) for doi in _DOI.findall(text or "")]
+    found += [doi for doi in dois if not any(doi in url for url in found)]
+    return found
+
+
+def changed_cells(
+    old_df: Optional[pd.DataFrame], new_df: Optional[pd.DataFrame]
+) -> List[Tuple[str, str, str]]:
+    """(medication, column, value) of the cells that are new or changed in `new_df`."""
+    if new_df is None or new_df.empty:
+        return []
+
+    name_column = get_name_column(new_df)
+    new = new_df.drop_duplicates(subset=name_column).set_index(name_column).astype(str)
+    if old_df is not None and name_column in old_df.columns:
+        old = old_df.drop_duplicates(subset=name_column).set_index(name_column).astype(str)
+        old = old.reindex(index=new.index, columns=new.columns)
+    else:
+        old = pd.DataFrame(index=new.index, columns=new.columns)
+
+    changed = (new != old).stack()
+    return [
+        (str(medication), str(column), new.at[medication, column])
+        for medication, column in changed[changed].index
+    ]
+
+
+class ReferenceIndex:
+    """Deduplicated index of the references cited in a session, keyed by URL or DOI."""
+
+    def __init__(self):
+        self.references: Dict[str, Reference] = {}
+
+    def add(self, url_or_doi: str) -> Reference:
+        key, url, doi = reference_key(url_or_doi)
+        if key not in self.references:
+            self.references[key] = Reference(key=key, url=url, doi=doi)
+        return self.references[key]
+
+    def add_response(self, response: str, citations: Optional[List[str]] = None) -> List[Reference]:
+        """Index the references of a response, each counted once per response."""
+        references = {}
+        for url_or_doi in extract_references(response, citations):
+            reference = self.add(url_or_doi)
+            references[reference.key] = reference
+        for reference in references.values():
+            reference.mentions += 1
+        return list(references.values())
+
+    def link_table(
+        self,
+        response: str,
+        citations: Optional[List[str]],
+        old_df: Optional[pd.DataFrame],
+        new_df: Optional[pd.DataFrame],
+    ) -> None:
+        """Link the references of a response to the cells it added or changed.
+
+        Cells with citation markers (e.g. "[2]") are linked to those citations only,
+        other cells to all the references of the response.
+        """
+        keys = {
+            self.add(url_or_doi).key for url_or_doi in extract_references(response, citations)
+        }
+        for medication, column, value in changed_cells(old_df, new_df):
+            markers = [int(n) for n in _CITATION_MARKER.findall(value)]
+            cited = [
+                self.add(citations[n - 1]).key
+                for n in markers
+                if citations and 0 < n <= len(citations)
+            ]
+            for key in cited or keys:
+                self.references[key].cells.add((medication, column))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        rows = [
+            {
+                "Reference": reference.url,
+                "DOI": reference.doi or "",
+                "Mentions": reference.mentions,
+                "Cells": "; ".join(f"{m} / {c}" for m, c in sorted(reference.cells)),
+            }
+            for reference in self.references.values()
+        ]
+        return pd.DataFrame(rows, columns=["Reference", "DOI", "Mentions", "Cells"])
+
+    def search(self, query: str = "") -> pd.DataFrame:
+        """References whose URL, DOI or linked medication/column contain `query`."""
+        df = self.to_dataframe()
+        if not query:
+            return df
+        text = df["Reference"] + " " + df["DOI"] + " " + df["Cells"]
+        return df[text.str.contains(query, case=False, regex=False)]
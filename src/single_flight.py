@@ -0,0 +1,105 @@
+import threading
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
+
+
+class Flight:
+    """A single upstream LLM stream, shared by all the requests waiting for it.
+
+    The LLM calls stream cumulative responses (each chunk holds the full response
+    so far), so only the latest chunk is kept. Subscribers joining partway through
+    start from the latest chunk.
+    """
+
+    def __init__(self):
+        self.usage: Dict = {}  # Token usage reported by the provider
+        self.citations: List[str] = []  # Citations reported by the provider
+
+        self._latest = ""
+        self._version = 0
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+
+    def publish(self, chunk: str) -> None:
+        with self._condition:
+            self._latest = chunk
+            self._version += 1
+            self._condition.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._condition:
+            self._done = True
+            self._error = error
+            self._condition.notify_all()
+
+    def subscribe(self) -> Generator[str, None, None]:
+        """Yield the response as it grows, until the upstream stream ends."""
+        seen = 0
+        while True:
+            with self._condition:
+                while self._version == seen and not self._done:
+                    self._condition.wait()
+                version, latest, done, error = (
+                    self._version,
+                    self._latest,
+                    self._done,
+                    self._error,
+                )
+
+            if version != seen:
+                seen = version
+                yield latest
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """Coalesce identical in-flight requests into a single upstream stream.
+
+    The first request for a key starts the upstream stream in a background thread,
+    so it runs to completion even if that request goes away. Identical requests made
+    while it runs subscribe to the same stream instead of calling the provider again.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def join(
+        self, key: str, upstream: Callable[[Flight], Iterable[str]]
+    ) -> Tuple[Flight, bool]:
+        """Return the flight for `key`, and whether this call started it.
+
+        Args:
+            key (str): Fingerprint of the request, see `request_key`.
+            upstream (Callable): Called with the new flight to start the stream,
+                only if there is no flight for `key` yet.
+        """
+        with self._lock:
+            if key in self._flights:
+                return self._flights[key], False
+            flight = Flight()
+            self._flights[key] = flight
+
+        threading.Thread(
+            target=self._run, args=(key, flight, upstream), daemon=True
+        ).start()
+        return flight, True
+
+    def _run(self, key: str, flight: Flight, upstream: Callable[[Flight], Iterable[str]]):
+        error = None
+        try:
+            for chunk in upstream(flight):
+                flight.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            # New requests start a new flight from now on
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.finish(error)
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,213 @@
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from src.history import HistorySummary
+from src.references import ReferenceIndex
+
+load_dotenv()
+
+
+@dataclass
+class SessionState:
+    """Everything the app keeps for a single browser session."""
+
+    df_state: Optional[pd.DataFrame] = None  # Current DataFrame
+    df_before: List[pd.DataFrame] = field(default_factory=list)  # Undo history
+    df_after: List[pd.DataFrame] = field(default_factory=list)  # Redo history
+    last_response: str = ""  # Last LLM response
+    last_citations: List[str] = field(default_factory=list)  # Citations of the last response
+    references: ReferenceIndex = field(default_factory=ReferenceIndex)
+    history_summary: HistorySummary = field(default_factory=HistorySummary)  # Older chat turns
+    page: int = 0  # Table page shown in the browser
+    rendered: Optional[str] = None  # Fingerprint of the rows last sent to the browser
+
+
+def _df_nbytes(df) -> int:
+    if isinstance(df, pd.DataFrame):
+        return int(df.memory_usage(index=True, deep=True).sum())
+    return 0
+
+
+def _state_nbytes(state: SessionState) -> int:
+    """Approximate the in-memory footprint of a session."""
+    tables = [state.df_state] + state.df_before + state.df_after
+    return sum(_df_nbytes(df) for df in tables) + len(state.last_response)
+
+
+def new_session_id() -> str:
+    """Create a random id for a new browser session."""
+    return uuid.uuid4().hex
+
+
+class SessionStore:
+    """LRU store of per-session state with a memory budget shared by all sessions.
+
+    The most recently used sessions are kept in memory. Once the total size goes
+    over `max_memory_bytes`, the least recently used sessions are written to
+    compressed files in `spill_dir` and loaded back the next time they are used.
+    Sessions are never spilled while an event is using them: every `get` must be
+    followed by a `put`, see `session`.
+
+    Args:
+        max_memory_bytes (int): Memory budget across all in-memory sessions.
+        spill_dir (str): Directory for spilled sessions. A temp dir if not provided.
+    """
+
+    def __init__(self, max_memory_bytes: int, spill_dir: Optional[str] = None):
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="med-copilot-sessions-")
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._sizes = {}
+        self._in_use = defaultdict(int)  # Number of events using each session
+        self._dropped = set()  # Sessions dropped while in use, forgotten by the last `put`
+        # Sessions being written to disk, with a token identifying the pending write
+        self._spilling: Dict[str, Tuple[SessionState, object]] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        """Create a store configured by `SESSION_MEMORY_BUDGET_MB` and `SESSION_SPILL_DIR`."""
+        budget_mb = float(os.environ.get("SESSION_MEMORY_BUDGET_MB", 512))
+        return cls(
+            max_memory_bytes=int(budget_mb * 1024 * 1024),
+            spill_dir=os.environ.get("SESSION_SPILL_DIR"),
+        )
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{session_id}.pkl.gz")
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[SessionState]:
+        """Use a session's state for the duration of an event, and store it back afterwards."""
+        state = self.get(session_id)
+        try:
+            yield state
+        finally:
+            self.put(session_id, state)
+
+    def get(self, session_id: str) -> SessionState:
+        """Return the session's state, loading it from disk if it was spilled.
+        The session stays in memory until the matching `put`."""
+        with self._lock:
+            self._in_use[session_id] += 1
+            if session_id in self._sessions:
+                self._sessions.move_to_end(session_id)
+                return self._sessions[session_id]
+
+            path = self._spill_path(session_id)
+            if session_id in self._spilling:
+                # Still being written, the pending write is discarded
+                state, _ = self._spilling.pop(session_id)
+            elif os.path.exists(path):
+                state = pd.read_pickle(path, compression="gzip")
+                os.remove(path)
+            else:
+                state = SessionState()
+
+            self._sessions[session_id] = state
+            self._sizes[session_id] = _state_nbytes(state)
+            victims = self._evict()
+
+        self._spill(victims)
+        return state
+
+    def put(self, session_id: str, state: SessionState) -> None:
+        """Store (or re-measure) a session's state, release it and evict cold sessions if needed."""
+        with self._lock:
+            self._sessions[session_id] = state
+            self._sessions.move_to_end(session_id)
+            self._sizes[session_id] = _state_nbytes(state)
+
+            self._in_use[session_id] -= 1
+            if self._in_use[session_id] <= 0:
+                del self._in_use[session_id]
+                if session_id in self._dropped:
+                    self._dropped.discard(session_id)
+                    self._forget(session_id)
+
+            victims = self._evict()
+
+        self._spill(victims)
+
+    def drop(self, session_id: str) -> None:
+        """Forget a session, both in memory and on disk. A session that is in use
+        is forgotten once the last event using it is done."""
+        with self._lock:
+            if session_id in self._in_use:
+                self._dropped.add(session_id)
+            else:
+                self._forget(session_id)
+
+    def _forget(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+        self._sizes.pop(session_id, None)
+        self._spilling.pop(session_id, None)
+        path = self._spill_path(session_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _evict(self) -> List[Tuple[str, SessionState, object]]:
+        """Pick the sessions to spill. Called with the lock held, the files are
+        written by `_spill` once it is released."""
+        # Sessions used by an event, and the most recent one, stay in memory even if over budget
+        idle = [
+            session_id
+            for session_id in list(self._sessions)[:-1]
+            if session_id not in self._in_use
+        ]
+        victims = []
+        for session_id in idle:  # Least recently used first
+            if self.memory_bytes <= self.max_memory_bytes:
+                break
+            state = self._sessions.pop(session_id)
+            self._sizes.pop(session_id, None)
+            token = object()
+            self._spilling[session_id] = (state, token)
+            victims.append((session_id, state, token))
+        return victims
+
+    def _spill(self, victims: List[Tuple[str, SessionState, object]]) -> None:
+        """Write evicted sessions to disk without holding the lock. A write is only
+        kept if the session was not used or dropped in the meantime."""
+        for session_id, state, token in victims:
+            path = self._spill_path(session_id)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                pd.to_pickle(state, tmp_path, compression="gzip")
+                error = None
+            except Exception as e:  # e.g. a full disk
+                error = e
+
+            with self._lock:
+                current = self._spilling.get(session_id, (None, None))[1] is token
+                if current:
+                    del self._spilling[session_id]
+                if current and error is None:
+                    os.replace(tmp_path, path)
+                    continue
+
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if current:
+                    print(f"Could not spill session {session_id}, keeping it in memory: {error}")
+                    self._sessions[session_id] = state
+                    self._sessions.move_to_end(session_id, last=False)
+                    self._sizes[session_id] = _state_nbytes(state)
+
+
+session_store = SessionStore.from_env()
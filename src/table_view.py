@@ -0,0 +1,91 @@
+import hashlib
+import math
+import os
+from typing import Optional
+
+import gradio as gr
+import pandas as pd
+from dotenv import load_dotenv
+
+from src.state_store import SessionState
+
+load_dotenv()
+
+PAGE_SIZE = int(os.environ.get("TABLE_PAGE_SIZE", 100))
+
+
+def table_fingerprint(df: Optional[pd.DataFrame]) -> str:
+    """Hash of a table's columns and values, used to skip re-sending unchanged tables."""
+    if df is None:
+        return ""
+    try:
+        values = pd.util.hash_pandas_object(df, index=False).values.tobytes()
+    except TypeError:
+        # Unhashable cells (e.g. lists returned by the LLM)
+        values = df.to_json().encode("utf-8")
+    columns = str(list(df.columns)).encode("utf-8")
+    return hashlib.sha256(columns + values).hexdigest()
+
+
+def page_count(df: Optional[pd.DataFrame], page_size: int = PAGE_SIZE) -> int:
+    if df is None or len(df) == 0:
+        return 1
+    return math.ceil(len(df) / page_size)
+
+
+def get_page(df: Optional[pd.DataFrame], page: int, page_size: int = PAGE_SIZE):
+    """Rows of the given (zero based) page."""
+    if df is None:
+        return None
+    start = page * page_size
+    return df.iloc[start : start + page_size]
+
+
+def merge_page(
+    df: Optional[pd.DataFrame], page_df, page: int, page_size: int = PAGE_SIZE
+) -> pd.DataFrame:
+    """Put an edited page back in its place in the full table.
+    Rows and columns added or removed on the page are kept."""
+    page_df = pd.DataFrame(page_df)
+    if df is None:
+        return page_df
+
+    start = page * page_size
+    return pd.concat(
+        [df.iloc[:start], page_df, df.iloc[start + page_size :]], ignore_index=True
+    )
+
+
+def mark_rendered(state: SessionState, page_df) -> None:
+    """Record what the browser currently shows, e.g. after the user edited the table."""
+    state.rendered = table_fingerprint(pd.DataFrame(page_df))
+
+
+def render_table(state: SessionState, page: Optional[int] = None, page_size: int = PAGE_SIZE):
+    """Return the updates for the table display and the page selector.
+
+    Only the rows of the current page are sent to the browser, and nothing is sent
+    if they are identical to what was rendered last.
+
+    Args:
+        state (SessionState): The session to render.
+        page (int): Zero based page to show. Defaults to the session's current page.
+        page_size (int): Number of rows per page.
+    """
+    n_pages = page_count(state.df_state, page_size)
+    if page is None:
+        page = state.page
+    state.page = min(max(page, 0), n_pages - 1)
+
+    page_df = get_page(state.df_state, state.page, page_size)
+    fingerprint = table_fingerprint(page_df)
+    if fingerprint == state.rendered:
+        display_update = gr.update()
+    else:
+        display_update = gr.update(value=page_df)
+        state.rendered = fingerprint
+
+    page_update = gr.update(
+        value=state.page + 1, maximum=n_pages, label=f"Page (of {n_pages})"
+    )
+    return display_update, page_update
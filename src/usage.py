@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# USD per 1M (prompt, completion) tokens
+MODEL_PRICES = {
+    "sonar-pro": (3.0, 15.0),
+    "sonar": (1.0, 1.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o-mini": (0.15, 0.6),
+}
+
+DEFAULT_MODELS = {"Perplexity": "sonar-pro", "OpenAI": "gpt-4-turbo"}
+
+# Model to fall back to when a turn would go over budget
+CHEAPER_MODELS = {"sonar-pro": "sonar", "gpt-4-turbo": "gpt-4o-mini"}
+
+# Response of a turn refused because it does not fit in the budget
+BUDGET_REACHED_MESSAGE = "The usage budget for this session or API key has been reached."
+
+
+class BudgetExceededError(Exception):
+    """A request was not sent because it does not fit in the usage budget."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def estimate_messages_tokens(messages: List[Dict]) -> int:
+    return sum(estimate_tokens(str(message.get("content", ""))) for message in messages)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Cost in USD of a request, based on `MODEL_PRICES`. Unknown models are free."""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def hash_api_key(api_key: Optional[str]) -> str:
+    """Ledger key for an API key, so the key itself is never kept around."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+def request_key(full_messages: List[Dict], llm_type: str, model: str) -> str:
+    """Fingerprint of a provider request, identical inputs give an identical key."""
+    payload = json.dumps(
+        {"llm_type": llm_type, "model": model, "messages": full_messages},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class UsageLedger:
+    """Token usage and cost per session and per API key, with optional budgets.
+
+    Args:
+        session_budget (float): Max USD spend per session. None for no limit.
+        api_key_budget (float): Max USD spend per API key. None for no limit.
+    """
+
+    def __init__(
+        self,
+        session_budget: Optional[float] = None,
+        api_key_budget: Optional[float] = None,
+    ):
+        self.session_budget = session_budget
+        self.api_key_budget = api_key_budget
+
+        self._sessions = defaultdict(self._empty_entry)
+        self._api_keys = defaultdict(self._empty_entry)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "UsageLedger":
+        """Create a ledger with budgets from `SESSION_BUDGET_USD` and `API_KEY_BUDGET_USD`."""
+        session_budget = os.environ.get("SESSION_BUDGET_USD")
+        api_key_budget = os.environ.get("API_KEY_BUDGET_USD")
+        return cls(
+            session_budget=float(session_budget) if session_budget else None,
+            api_key_budget=float(api_key_budget) if api_key_budget else None,
+        )
+
+    @staticmethod
+    def _empty_entry() -> Dict:
+        return {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cost": 0.0,
+            "requests": 0,
+            "shared_requests": 0,  # Requests served by another session's identical request
+        }
+
+    def record(
+        self,
+        session_id: Optional[str],
+        api_key: Optional[str],
+        model: str,
+        usage: Dict,
+        shared: bool = False,
+    ) -> float:
+        """Add the usage returned by a provider to the ledger and return its cost.
+
+        Shared usage (a response streamed by a request of another session) only
+        counts against the session, the API key was already charged once.
+        """
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+
+        with self._lock:
+            entries = [] if shared else [self._api_keys[hash_api_key(api_key)]]
+            if session_id:
+                entries.append(self._sessions[session_id])
+            for entry in entries:
+                entry["prompt_tokens"] += prompt_tokens
+                entry["completion_tokens"] += completion_tokens
+                entry["cost"] += cost
+                entry["requests"] += 1
+                if shared:
+                    entry["shared_requests"] += 1
+
+        return cost
+
+    def session_usage(self, session_id: str) -> Dict:
+        with self._lock:
+            return dict(self._sessions.get(session_id, self._empty_entry()))
+
+    def api_key_usage(self, api_key: Optional[str]) -> Dict:
+        with self._lock:
+            return dict(self._api_keys.get(hash_api_key(api_key), self._empty_entry()))
+
+    def remaining(self, session_id: Optional[str], api_key: Optional[str]) -> float:
+        """USD left before hitting the tightest of the session and API key budgets."""
+        remaining = float("inf")
+        if self.session_budget is not None and session_id:
+            remaining = self.session_budget - self.session_usage(session_id)["cost"]
+        if self.api_key_budget is not None:
+            remaining = min(
+                remaining, self.api_key_budget - self.api_key_usage(api_key)["cost"]
+            )
+        return remaining
+
+    def can_afford(
+        self,
+        session_id: Optional[str],
+        api_key: Optional[str],
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+    ) -> bool:
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+        return cost <= self.remaining(session_id, api_key)
+
+
+class ResponseCache:
+    """Small LRU cache of final responses, keyed by `request_key`."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._responses: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._responses:
+                return None
+            self._responses.move_to_end(key)
+            return self._responses[key]
+
+    def put(self, key: str, response: str) -> None:
+        with self._lock:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_entries:
+                self._responses.popitem(last=False)
+
+
+usage_ledger = UsageLedger.from_env()
+response_cache = ResponseCache()
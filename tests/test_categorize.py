@@ -0,0 +1,30 @@
+import json
+
+import pandas as pd
+
+import src.llm_calls as llm_calls
+from src.categorize import categorize_columns
+from src.usage import estimate_tokens
+
+
+def test_budget_check_expects_a_mapping_of_the_distinct_values(monkeypatch):
+    doses = [f"{i} mg" for i in range(1, 8)]
+    df = pd.DataFrame({"Name": [f"Medication {i}" for i in range(7)], "Dose": doses})
+    mapping = {"Dose": {dose: "Low" for dose in doses}}
+    expected = []
+
+    def can_afford(session_id, api_key, model, prompt_tokens, completion_tokens):
+        expected.append(completion_tokens)
+        return True
+
+    def fake_openai(full_messages, api_key, model, usage_callback):
+        yield json.dumps(mapping)
+
+    monkeypatch.setattr(llm_calls.usage_ledger, "can_afford", can_afford)
+    monkeypatch.setattr(llm_calls, "query_openai", fake_openai)
+
+    categorized = categorize_columns(df, "OpenAI", "key", max_categories=5)
+
+    assert categorized["Dose"].tolist() == ["Low"] * 7
+    assert expected == [2 * estimate_tokens(json.dumps({"Dose": doses}))]
+    assert expected[0] < 500
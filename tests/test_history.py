@@ -0,0 +1,46 @@
+import json
+
+import pandas as pd
+
+from src.history import DATASET_PLACEHOLDER, compact_history, latest_dataset_applied
+
+DATASET = {"Medications": [{"Name": "Valproic acid"}, {"Name": "Metformin"}]}
+
+
+def _history(n_turns):
+    history = []
+    for i in range(n_turns):
+        history.append({"role": "user", "content": f"Request {i}"})
+        history.append(
+            {
+                "role": "assistant",
+                "content": f"Answer {i}.\n```json\n{json.dumps(DATASET)}\n```",
+            }
+        )
+    return history
+
+
+def test_latest_dataset_is_kept_until_applied():
+    history = _history(1)
+
+    assert not latest_dataset_applied(history, None)
+    compacted = compact_history(history, keep_latest_dataset=True)
+    assert "Valproic acid" in compacted
+    assert DATASET_PLACEHOLDER not in compacted
+
+
+def test_datasets_are_stripped_once_applied():
+    history = _history(2)
+    df = pd.DataFrame(DATASET["Medications"])
+
+    assert latest_dataset_applied(history, df)
+    compacted = compact_history(history, keep_latest_dataset=False)
+    assert "Valproic acid" not in compacted
+    assert DATASET_PLACEHOLDER in compacted
+
+
+def test_only_the_latest_dataset_is_kept():
+    compacted = compact_history(_history(2), keep_latest_dataset=True)
+
+    assert compacted.count("Valproic acid") == 1
+    assert compacted.count(DATASET_PLACEHOLDER) == 1
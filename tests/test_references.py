@@ -0,0 +1,22 @@
+from src.references import ReferenceIndex, extract_references
+
+WIKIPEDIA = "https://en.wikipedia.org/wiki/Retinitis_pigmentosa_(disease)"
+
+
+def test_urls_keep_balanced_parentheses():
+    text = f"See {WIKIPEDIA}, and [the review]({WIKIPEDIA}) (also {WIKIPEDIA})."
+
+    assert extract_references(text) == [WIKIPEDIA] * 3
+
+
+def test_unbalanced_closing_parenthesis_is_stripped():
+    text = "Valproic acid (https://pubmed.ncbi.nlm.nih.gov/123/)."
+
+    assert extract_references(text) == ["https://pubmed.ncbi.nlm.nih.gov/123/"]
+
+
+def test_dois_keep_balanced_parentheses():
+    index = ReferenceIndex()
+    (reference,) = index.add_response("Source: doi 10.1016/S0140-6736(20)30183-5.")
+
+    assert reference.key == "doi:10.1016/s0140-6736(20)30183-5"
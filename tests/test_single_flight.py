@@ -0,0 +1,41 @@
+import threading
+import time
+
+import src.llm_calls as llm_calls
+from src.gradio_utils import chat_with_session
+
+
+def test_concurrent_identical_chats_share_one_provider_call(monkeypatch):
+    calls = []
+
+    def fake_perplexity(full_messages, api_key, model, usage_callback, citations_callback):
+        calls.append(model)
+        response = ""
+        for word in ["Hello", " from", " the", " provider"]:
+            time.sleep(0.05)
+            response += word
+            yield response
+        usage_callback({"prompt_tokens": 10, "completion_tokens": 4})
+
+    monkeypatch.setattr(llm_calls, "query_perplexity", fake_perplexity)
+
+    started = threading.Barrier(2)
+    responses = {}
+
+    def chat(session_id):
+        started.wait()
+        *_, responses[session_id] = chat_with_session(
+            "List medications", [], session_id, "Perplexity", "key", "system prompt"
+        )
+
+    threads = [threading.Thread(target=chat, args=(f"session-{i}",)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert responses == {
+        "session-0": "Hello from the provider",
+        "session-1": "Hello from the provider",
+    }
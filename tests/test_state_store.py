@@ -0,0 +1,62 @@
+import os
+
+import pandas as pd
+
+from src.state_store import SessionStore
+
+
+def _store(tmp_path, max_memory_bytes=10**9):
+    return SessionStore(max_memory_bytes=max_memory_bytes, spill_dir=str(tmp_path))
+
+
+def test_drop_while_in_use_is_applied_after_the_event(tmp_path):
+    store = _store(tmp_path)
+
+    with store.session("c") as state:
+        state.df_state = pd.DataFrame({"Name": ["Metformin"]})
+        store.drop("c")  # The browser tab closed mid-event
+
+    assert "c" not in store._sessions
+    assert store.memory_bytes == 0
+    assert store.get("c").df_state is None
+
+
+
+def test_idle_sessions_are_spilled_and_loaded_back(tmp_path):
+    store = _store(tmp_path, max_memory_bytes=1)
+
+    with store.session("a") as state:
+        state.df_state = pd.DataFrame({"Name": ["Metformin"]})
+    with store.session("b"):
+        pass
+
+    assert "a" not in store._sessions
+    assert os.path.exists(store._spill_path("a"))
+    with store.session("a") as state:
+        assert state.df_state["Name"].tolist() == ["Metformin"]
+    assert not os.path.exists(store._spill_path("a"))
+
+
+def test_session_used_while_spilling_is_not_overwritten(tmp_path, monkeypatch):
+    store = _store(tmp_path, max_memory_bytes=1)
+    with store.session("a") as state:
+        state.df_state = pd.DataFrame({"Name": ["Metformin"]})
+
+    to_pickle = pd.to_pickle
+
+    def to_pickle_while_used(obj, path, **kwargs):
+        # "a" is used by another event while its file is being written
+        monkeypatch.setattr(pd, "to_pickle", to_pickle)
+        assert "a" in store._spilling
+        with store.session("a") as used:
+            used.df_state = pd.DataFrame({"Name": ["Lisinopril"]})
+        to_pickle(obj, path, **kwargs)
+
+    monkeypatch.setattr(pd, "to_pickle", to_pickle_while_used)
+    with store.session("b"):
+        pass
+
+    assert "a" not in store._spilling
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+    with store.session("a") as state:
+        assert state.df_state["Name"].tolist() == ["Lisinopril"]